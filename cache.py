@@ -0,0 +1,68 @@
+# cache.py
+"""
+Small on-disk TTL cache used by ipo_alerts_auto.py so that repeated runs
+within a short window do not hit FMP/Finnhub/NSE/BSE/Yahoo again.
+Entries are stored as JSON under .cache/{endpoint}/{md5(params)}.json.
+"""
+import os
+import json
+import time
+import hashlib
+import functools
+import threading
+
+CACHE_DIR = os.getenv("IPO_CACHE_DIR", ".cache")
+
+
+class FileCache:
+    def __init__(self, root=CACHE_DIR):
+        self.root = root
+
+    def _path(self, endpoint, params):
+        key = hashlib.md5(repr(params).encode("utf-8")).hexdigest()
+        return os.path.join(self.root, endpoint, f"{key}.json")
+
+    def get(self, endpoint, params, ttl_seconds):
+        path = self._path(endpoint, params)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get("ts", 0) >= ttl_seconds:
+            return None
+        return entry.get("value")
+
+    def set(self, endpoint, params, value):
+        path = self._path(endpoint, params)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                # default=str keeps dates serialisable; callers re-parse them
+                json.dump({"ts": time.time(), "value": value}, f, default=str)
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError) as e:
+            print("Cache write error for", endpoint, e)
+
+
+_cache = FileCache()
+
+
+def cached(ttl_seconds):
+    """Cache a function's result on disk for ttl_seconds, keyed by its name
+    and arguments. Empty results (None, [], {}) are not cached so failed
+    fetches are retried on the next call."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            params = (args, sorted(kwargs.items()))
+            value = _cache.get(func.__name__, params, ttl_seconds)
+            if value is not None:
+                return value
+            value = func(*args, **kwargs)
+            if value:
+                _cache.set(func.__name__, params, value)
+            return value
+        return wrapper
+    return decorator
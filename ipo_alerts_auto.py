@@ -1,17 +1,19 @@
 # ipo_alerts_auto.py
 """
-Auto-fetch IPOs (tries FMP -> Finnhub -> fallback scraping NSE/BSE),
+Auto-fetch today's IPOs (FMP + Finnhub, falling back to NSE/BSE scraping),
 checks today's listings, calculates gain (via yfinance), sends Telegram alert
 if gain is within MIN_GAIN..MAX_GAIN, and ALWAYS sends a short daily summary.
 """
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import datetime
-import yfinance as yf
-from bs4 import BeautifulSoup
-import time
+from io import StringIO
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from cache import cached
 
 # ---------- Configuration from environment ----------
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -21,36 +23,75 @@ MAX_GAIN = float(os.getenv("MAX_GAIN", "30"))
 
 FMP_API_KEY = os.getenv("FMP_API_KEY")        # optional
 FINNHUB_API_KEY = os.getenv("FINNHUB_API_KEY")# optional
+LTP_WORKERS = int(os.getenv("LTP_WORKERS", "8"))  # keep low to avoid Yahoo rate-limits
 
 IPOS_CSV = "ipos.csv"   # fallback storage (we still keep for reference)
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
+TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage" if TELEGRAM_BOT_TOKEN else None
+TELEGRAM_MAX_LEN = 4096     # Telegram's per-message text limit
+LTP_CACHE_TTL = 60          # seconds; listing-day LTP moves slowly within a minute
+IPO_CACHE_TTL = 60 * 60     # seconds; IPO calendars change rarely within an hour
+
+# ---------- Shared HTTP session (connection pooling + keep-alive) ----------
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": USER_AGENT})
+# urllib3 retries 429/5xx with exponential backoff + jitter (GETs only, so
+# Telegram posts are never duplicated)
+_retry = Retry(total=3, status_forcelist=[429, 500, 502, 503, 504], backoff_factor=0.5,
+               backoff_jitter=0.25, respect_retry_after_header=True)
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=_retry)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
 
 # ---------- Helper: Telegram send ----------
 def send_telegram(message):
-    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
+    if not TELEGRAM_URL or not TELEGRAM_CHAT_ID:
         print("Telegram token or chat id not set.")
         return False
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        resp = requests.post(url, data={"chat_id": TELEGRAM_CHAT_ID, "text": message}, timeout=15)
+        resp = SESSION.post(TELEGRAM_URL, json={"chat_id": TELEGRAM_CHAT_ID, "text": message}, timeout=15)
         print("Telegram send status:", resp.status_code)
         return resp.status_code == 200
     except Exception as e:
         print("Telegram exception:", e)
         return False
 
+def send_telegram_batch(messages):
+    """Send several messages as few Telegram posts as possible by joining
+    them with blank lines, splitting only where TELEGRAM_MAX_LEN is hit."""
+    chunks, current = [], ""
+    for msg in messages:
+        candidate = f"{current}\n\n{msg}" if current else msg
+        if current and len(candidate) > TELEGRAM_MAX_LEN:
+            chunks.append(current)
+            current = msg
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return all([send_telegram(chunk) for chunk in chunks])
+
 # ---------- Helper: get LTP via yfinance ----------
+YF_SUFFIX = {"NSE": ".NS", "BSE": ".BO"}
+
+def yf_ticker(symbol, exchange):
+    return symbol + YF_SUFFIX.get(exchange.upper(), "")
+
+@cached(ttl_seconds=LTP_CACHE_TTL)
 def get_ltp(symbol, exchange):
     if not symbol or symbol.strip() == "":
         return None
-    if exchange.upper() == "NSE":
-        ticker = f"{symbol}.NS"
-    elif exchange.upper() == "BSE":
-        ticker = f"{symbol}.BO"
-    else:
-        ticker = symbol
+    ticker = yf_ticker(symbol, exchange)
+    import yfinance as yf  # heavy import; only paid when a listing needs pricing
     try:
         tk = yf.Ticker(ticker)
+        # fast_info is a much lighter call than pulling 1m bars
+        try:
+            price = tk.fast_info["last_price"]
+            if price is not None and not pd.isna(price):
+                return float(price)
+        except Exception as e:
+            print("yfinance fast_info error for", ticker, e)
         df = tk.history(period="1d", interval="1m")
         if df is None or df.empty:
             return None
@@ -59,25 +100,95 @@ def get_ltp(symbol, exchange):
         print("yfinance error for", ticker, e)
         return None
 
+# ---------- Helper: batched LTPs via one yf.download call ----------
+def batch_ltps(tickers):
+    """Return {ticker: last close} for all tickers using a single download.
+    Tickers with no data are left out of the result."""
+    if not tickers:
+        return {}
+    import yfinance as yf  # heavy import; only paid when a listing needs pricing
+    try:
+        data = yf.download(tickers=" ".join(tickers), period="1d", interval="1m",
+                           group_by="ticker", threads=True, progress=False)
+    except Exception as e:
+        print("yfinance batch download error:", e)
+        return {}
+    results = {}
+    if data is None or data.empty:
+        return results
+    multi = isinstance(data.columns, pd.MultiIndex)
+    for t in tickers:
+        try:
+            if multi:
+                if t not in data.columns.get_level_values(0):
+                    continue
+                close = data[t]['Close'].dropna()
+            elif len(tickers) == 1:
+                close = data['Close'].dropna()
+            else:
+                continue
+            if not close.empty:
+                results[t] = float(close.iloc[-1])
+        except Exception as e:
+            print("yfinance batch parse error for", t, e)
+    return results
+
+# ---------- Helper: fetch LTPs for all rows ----------
+def fetch_ltps(rows):
+    """Return LTPs for (symbol, exchange) rows in input order. They are
+    fetched in one batched download; empty slices fall back to per-ticker
+    lookups run concurrently."""
+    ltps = [None] * len(rows)
+    pending = {i: yf_ticker(sym, exch) for i, (sym, exch) in enumerate(rows) if sym}
+    if not pending:
+        return ltps
+    batch = batch_ltps(sorted(set(pending.values())))
+    missing = []
+    for i, ticker in pending.items():
+        if ticker in batch:
+            ltps[i] = batch[ticker]
+        else:
+            missing.append(i)
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(1, min(LTP_WORKERS, len(missing)))) as ex:
+            found = ex.map(lambda i: get_ltp(rows[i][0], rows[i][1]), missing)
+            for i, ltp in zip(missing, found):
+                ltps[i] = ltp
+    return ltps
+
+# ---------- Helper: raw source rows -> IPO records ----------
+def parse_dates(values):
+    """Parse a column of date strings in one vectorised pass.
+    Unparseable values become NaT."""
+    return pd.to_datetime(pd.Series(values), errors="coerce", format="mixed").dt.date
+
+def to_records(rows, target_date=None):
+    """Turn rows with raw listing_date strings into IPO records, parsing all
+    dates at once and dropping the ones that could not be parsed. With
+    target_date, only records listing on that date are kept."""
+    df = pd.DataFrame(rows, columns=['symbol','exchange','issue_price','listing_date'])
+    df['listing_date'] = parse_dates(df['listing_date'])
+    df = df.dropna(subset=['listing_date'])
+    if target_date is not None:
+        df = df[df['listing_date'] == target_date]
+    return df.to_dict("records")
+
 # ---------- Fetch via FinancialModelingPrep ----------
-def fetch_fmp_ipos():
+@cached(ttl_seconds=IPO_CACHE_TTL)
+def fetch_fmp_ipos(target_date=None):
     if not FMP_API_KEY:
         return []
     url = f"https://financialmodelingprep.com/api/v3/ipo_calendar?apikey={FMP_API_KEY}"
     try:
-        r = requests.get(url, timeout=15)
+        r = SESSION.get(url, timeout=15)
         r.raise_for_status()
         data = r.json()
-        results = []
-        for item in data:
-            date_str = item.get("date") or item.get("dateIPO") or item.get("offerDate")
-            try:
-                dt = pd.to_datetime(date_str).date()
-            except:
-                continue
-            symbol = item.get("symbol") or ""
-            price = item.get("price") or item.get("priceFrom") or item.get("priceTo") or None
-            results.append({"symbol": symbol, "exchange": "NSE", "issue_price": price, "listing_date": dt})
+        results = to_records([{
+            "symbol": item.get("symbol") or "",
+            "exchange": "NSE",
+            "issue_price": item.get("price") or item.get("priceFrom") or item.get("priceTo") or None,
+            "listing_date": item.get("date") or item.get("dateIPO") or item.get("offerDate"),
+        } for item in data], target_date)
         print("FMP returned", len(results), "items")
         return results
     except Exception as e:
@@ -85,57 +196,73 @@ def fetch_fmp_ipos():
         return []
 
 # ---------- Fetch via Finnhub ----------
-def fetch_finnhub_ipos():
+@cached(ttl_seconds=IPO_CACHE_TTL)
+def fetch_finnhub_ipos(target_date=None):
     if not FINNHUB_API_KEY:
         return []
-    today = datetime.date.today()
-    url = f"https://finnhub.io/api/v1/calendar/ipo?from={today}&to={today}&token={FINNHUB_API_KEY}"
+    day = target_date or datetime.date.today()
+    url = f"https://finnhub.io/api/v1/calendar/ipo?from={day}&to={day}&token={FINNHUB_API_KEY}"
     try:
-        r = requests.get(url, timeout=15)
+        r = SESSION.get(url, timeout=15)
         r.raise_for_status()
         data = r.json()
         items = data.get('ipoCalendar') or data.get('data') or data
-        results = []
-        for item in items:
-            date_str = item.get('date') or item.get('startDate') or item.get('offerDate')
-            try:
-                dt = pd.to_datetime(date_str).date()
-            except:
-                continue
-            symbol = item.get('symbol') or item.get('ticker') or ""
-            price = item.get('price') or item.get('priceFrom') or None
-            results.append({"symbol": symbol, "exchange": "NSE", "issue_price": price, "listing_date": dt})
+        results = to_records([{
+            "symbol": item.get('symbol') or item.get('ticker') or "",
+            "exchange": "NSE",
+            "issue_price": item.get('price') or item.get('priceFrom') or None,
+            "listing_date": item.get('date') or item.get('startDate') or item.get('offerDate'),
+        } for item in items], target_date)
         print("Finnhub returned", len(results), "items")
         return results
     except Exception as e:
         print("Finnhub fetch error:", e)
         return []
 
+# ---------- Helper: scraped HTML table -> IPO records ----------
+def table_records(table, symbol_col, date_col, exchange, target_date=None):
+    table = table.dropna(how="all")
+    return to_records(pd.DataFrame({
+        "symbol": table.iloc[:, symbol_col].fillna("").astype(str).str.split().str[0].fillna(""),
+        "exchange": exchange,
+        "issue_price": None,
+        "listing_date": table.iloc[:, date_col],
+    }), target_date)
+
+def read_tables(html):
+    try:
+        return pd.read_html(StringIO(html), flavor="lxml", header=0)
+    except ValueError:  # no <table> in the page
+        return []
+
 # ---------- Fallback scraping: NSE ----------
-def scrape_nse_upcoming():
+@cached(ttl_seconds=IPO_CACHE_TTL)
+def scrape_nse_upcoming(target_date=None):
     url = "https://www.nseindia.com/market-data/all-upcoming-issues-ipo"
-    headers = {"User-Agent": USER_AGENT, "Accept": "text/html"}
+    api_url = "https://www.nseindia.com/api/ipo-current-issue"
+    headers = {"Accept": "text/html"}
     try:
-        s = requests.Session()
-        s.headers.update(headers)
-        s.get("https://www.nseindia.com", timeout=10)  # get cookies
-        r = s.get(url, timeout=15)
-        soup = BeautifulSoup(r.text, "lxml")
-        results = []
-        table = soup.find("table")
-        if not table:
+        SESSION.get("https://www.nseindia.com", headers=headers, timeout=10)  # get cookies
+        # the JSON API returns typed fields directly; HTML only if it is blocked
+        r = SESSION.get(api_url, headers={"Accept": "application/json", "Referer": url}, timeout=15)
+        if r.status_code != 403:
+            r.raise_for_status()
+            data = r.json()
+            items = data if isinstance(data, list) else data.get('data') or []
+            results = to_records([{
+                "symbol": str(item.get('symbol') or "").strip(),
+                "exchange": "NSE",
+                "issue_price": item.get('issuePrice'),
+                "listing_date": item.get('listingDate'),
+            } for item in items], target_date)
+            print("NSE API returned", len(results))
             return results
-        rows = table.find_all("tr")
-        for tr in rows[1:]:
-            cols = [c.get_text(strip=True) for c in tr.find_all("td")]
-            if len(cols) < 4:
-                continue
-            symbol = cols[1].split()[0] if cols[1] else ""
-            try:
-                listing_date = pd.to_datetime(cols[3]).date()
-            except:
-                listing_date = None
-            results.append({"symbol": symbol, "exchange": "NSE", "issue_price": None, "listing_date": listing_date})
+        print("NSE API returned 403; falling back to HTML scrape")
+        r = SESSION.get(url, headers=headers, timeout=15)
+        tables = read_tables(r.text)
+        if not tables or tables[0].shape[1] < 4:
+            return []
+        results = table_records(tables[0], symbol_col=1, date_col=3, exchange="NSE", target_date=target_date)
         print("NSE scrape returned", len(results))
         return results
     except Exception as e:
@@ -143,26 +270,22 @@ def scrape_nse_upcoming():
         return []
 
 # ---------- Fallback scraping: BSE ----------
-def scrape_bse_public_issues():
+@cached(ttl_seconds=IPO_CACHE_TTL)
+def scrape_bse_public_issues(target_date=None):
     url = "https://www.bseindia.com/markets/PublicIssues/frmPublicIssues.aspx"
-    headers = {"User-Agent": USER_AGENT}
     try:
-        r = requests.get(url, headers=headers, timeout=15)
-        soup = BeautifulSoup(r.text, "lxml")
-        results = []
-        tables = soup.find_all("table")
-        for table in tables:
-            rows = table.find_all("tr")
-            for tr in rows[1:]:
-                cols = [c.get_text(strip=True) for c in tr.find_all("td")]
-                if not cols:
-                    continue
-                symbol = cols[0].split()[0] if cols else ""
-                try:
-                    listing_date = pd.to_datetime(cols[-1]).date()
-                except:
-                    listing_date = None
-                results.append({"symbol": symbol, "exchange": "BSE", "issue_price": None, "listing_date": listing_date})
+        r = SESSION.get(url, timeout=15)
+        import lxml.html
+        # one XPath pass over every data row of every table; header rows
+        # fall out when their date cell fails to parse
+        tree = lxml.html.fromstring(r.text)
+        cells = [[td.text_content().strip() for td in tr.xpath('./td')] for tr in tree.xpath('//table//tr[td]')]
+        results = to_records({
+            "symbol": [c[0].split()[0] if c[0] else "" for c in cells],
+            "exchange": "BSE",
+            "issue_price": None,
+            "listing_date": [c[-1] for c in cells],
+        }, target_date)
         print("BSE scrape returned", len(results))
         return results
     except Exception as e:
@@ -170,20 +293,38 @@ def scrape_bse_public_issues():
         return []
 
 # ---------- Collect IPOs from sources ----------
-def collect_ipos():
+# (name, fetcher) in order of preference when sources overlap, grouped into
+# tiers: scraping only runs when no API source had a listing for the date
+IPO_SOURCE_TIERS = [
+    [("fmp", fetch_fmp_ipos), ("finnhub", fetch_finnhub_ipos)],
+    [("nse", scrape_nse_upcoming), ("bse", scrape_bse_public_issues)],
+]
+IPO_SOURCE_NAMES = [name for tier in IPO_SOURCE_TIERS for name, _ in tier]
+
+def collect_ipos(target_date=None):
     ipos = []
-    if FMP_API_KEY:
-        ipos = fetch_fmp_ipos()
-    if not ipos and FINNHUB_API_KEY:
-        ipos = fetch_finnhub_ipos()
-    if not ipos:
-        ipos = scrape_nse_upcoming() + scrape_bse_public_issues()
+    for tier in IPO_SOURCE_TIERS:
+        # sources within a tier are independent endpoints: query them
+        # concurrently so the wait is the slowest source, not the sum
+        with ThreadPoolExecutor(max_workers=len(tier)) as ex:
+            batches = list(ex.map(lambda source: source[1](target_date), tier))
+        ipos += [dict(item, source=name) for (name, _), batch in zip(tier, batches) for item in batch]
+        if target_date is not None and ipos:
+            break
     if not ipos:
         print("No IPO data found from any source.")
-        return pd.DataFrame(columns=['symbol','exchange','issue_price','listing_date'])
+        return pd.DataFrame(columns=['symbol','exchange','issue_price','listing_date','source'])
     df = pd.DataFrame(ipos)
+    df['symbol'] = df['symbol'].fillna('').astype(str).str.strip().str.upper()
+    # keep listing_date as normalised datetime64 so the today-filter is a
+    # vectorised Timestamp comparison rather than a per-row .date() call
+    df['listing_date'] = pd.to_datetime(df['listing_date'], errors='coerce').dt.normalize()
     df = df.dropna(subset=['listing_date'])
-    df['listing_date'] = pd.to_datetime(df['listing_date']).dt.date
+    # an IPO listed by several sources must only be priced and alerted once;
+    # keep the row from the most trusted source (FMP > Finnhub > scraping)
+    df['source'] = pd.Categorical(df['source'], categories=IPO_SOURCE_NAMES, ordered=True)
+    df = df.sort_values('source', kind='stable')
+    df = df.drop_duplicates(subset=['symbol','exchange','listing_date'], keep='first')
     return df
 
 # ---------- Build summary message ----------
@@ -208,7 +349,7 @@ def main():
     today = datetime.date.today()
     print("Running IPO auto-check for", today)
     try:
-        df = collect_ipos()
+        df = collect_ipos(target_date=today)
         print("Total IPOs found:", len(df))
         # Save for reference
         if not df.empty:
@@ -216,48 +357,41 @@ def main():
                 df.to_csv(IPOS_CSV, index=False)
             except Exception as e:
                 print("Could not save ipos.csv:", e)
-        df_today = df[df['listing_date'] == today]
+        df_today = df[df['listing_date'] == pd.Timestamp(today)].copy()
+        df_today['symbol'] = df_today['symbol'].fillna('').astype(str).str.strip()
+        df_today['exchange'] = df_today['exchange'].fillna('').astype(str).str.strip().replace('', 'NSE')
+        # coerce numeric columns once; test_ltp (if present) overrides yfinance
+        issue = pd.to_numeric(df_today['issue_price'], errors='coerce')
+        df_today['issue'] = issue.where(issue > 0)
+        if 'test_ltp' in df_today:
+            df_today['ltp'] = pd.to_numeric(df_today['test_ltp'], errors='coerce')
+        else:
+            df_today['ltp'] = float('nan')
+        need = df_today['ltp'].isna()
+        if need.any():
+            # LTP lookups are network-bound; batch them in one go
+            ltps = fetch_ltps(list(zip(df_today.loc[need, 'symbol'], df_today.loc[need, 'exchange'])))
+            df_today.loc[need, 'ltp'] = pd.Series(ltps, index=df_today.index[need], dtype=float)
+        df_today['gain'] = (df_today['ltp'] - df_today['issue']) / df_today['issue'] * 100.0
+        for sym in df_today.loc[df_today['ltp'].isna(), 'symbol']:
+            print("LTP not found for", sym, "- skipping")
+        priced = df_today.dropna(subset=['ltp'])
+        messages = []
+        # send info even if issue price missing
+        for r in priced[priced['issue'].isna()].itertuples():
+            print(f"Issue price missing for {r.symbol}; sending LTP info only.")
+            messages.append(f"ℹ️ IPO Info: {r.symbol} ({r.exchange})\nLTP ₹{r.ltp:.2f}\nIssue price not available.")
+        priced = priced.dropna(subset=['issue'])
+        if not priced.empty:
+            print(priced[['symbol','exchange','issue','ltp','gain']].round(2).to_string(index=False))
+        matches = priced[(priced['gain'] >= MIN_GAIN) & (priced['gain'] <= MAX_GAIN)]
         alerts = []
-        for _, row in df_today.iterrows():
-            sym = str(row.get('symbol','')).strip()
-            exch = str(row.get('exchange','NSE')).strip() or "NSE"
-            issue = row.get('issue_price')
-            # test_ltp fallback (if present)
-            if 'test_ltp' in row and not pd.isna(row['test_ltp']):
-                ltp = float(row['test_ltp'])
-            else:
-                ltp = None
-                for attempt in range(2):
-                    ltp = get_ltp(sym, exch)
-                    if ltp is not None:
-                        break
-                    time.sleep(1)
-            if ltp is None:
-                print("LTP not found for", sym, "- skipping")
-                continue
-            if issue is None or pd.isna(issue):
-                # send info even if issue price missing
-                print(f"Issue price missing for {sym}; sending LTP info only.")
-                try:
-                    msg = f"ℹ️ IPO Info: {sym} ({exch})\nLTP ₹{ltp:.2f}\nIssue price not available."
-                    send_telegram(msg)
-                except Exception:
-                    print("Failed to send partial info for", sym)
-                continue
-            try:
-                issue = float(issue)
-                gain = (ltp - issue)/issue * 100.0
-            except Exception as e:
-                print("Calculation error for", sym, e)
-                continue
-            print(sym, exch, "issue", issue, "ltp", ltp, "gain", round(gain,2))
-            if MIN_GAIN <= gain <= MAX_GAIN:
-                msg = f"🔔 IPO Alert: {sym} ({exch})\nIssue ₹{issue:.2f} LTP ₹{ltp:.2f}\nGain {gain:.2f}%"
-                send_telegram(msg)
-                alerts.append({"symbol": sym, "exchange": exch, "issue": issue, "ltp": ltp, "gain": gain})
-        # build and send summary
-        summary = build_summary_message(today.strftime("%Y-%m-%d"), len(df_today), alerts)
-        send_telegram(summary)
+        for r in matches.itertuples():
+            messages.append(f"🔔 IPO Alert: {r.symbol} ({r.exchange})\nIssue ₹{r.issue:.2f} LTP ₹{r.ltp:.2f}\nGain {r.gain:.2f}%")
+            alerts.append({"symbol": r.symbol, "exchange": r.exchange, "issue": r.issue, "ltp": r.ltp, "gain": r.gain})
+        # build summary and send it together with any alerts in one post
+        messages.append(build_summary_message(today.strftime("%Y-%m-%d"), len(df_today), alerts))
+        send_telegram_batch(messages)
         print("Summary sent.")
     except Exception as exc:
         print("Unhandled exception:", exc)